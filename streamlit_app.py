@@ -1,6 +1,19 @@
+import io
+import json
+import os
+import re
+import threading
+import time
+import warnings
+import zipfile
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from pandas.tseries.api import guess_datetime_format
 import plotly.express as px
 import plotly.graph_objects as go
 from streamlit_gsheets import GSheetsConnection
@@ -47,7 +60,11 @@ st.markdown("""
 # =====================
 # CONNECT TO GOOGLE SHEETS
 # =====================
-@st.cache_data(ttl=0)
+# Date-dependent results are cached under the reference date (see below), so
+# the sheet itself can be cached between reruns; "Refresh Data" clears it.
+DATA_TTL_SECONDS = 300
+
+@st.cache_data(ttl=DATA_TTL_SECONDS)
 def load_data():
     url = "https://docs.google.com/spreadsheets/d/12UG2ofCyDGNl8jUKbuxMZrcTQJHh5G4Ypv_6FUc1luk/edit?gid=1073396090#gid=1073396090"
     #url = "https://docs.google.com/spreadsheets/d/12UG2ofCyDGNl8jUKbuxMZrcTQJHh5G4Ypv_6FUc1luk/edit?gid=599339940#gid=599339940"
@@ -80,47 +97,288 @@ TEXT_COLUMNS = [
     "Company Name"
 ]
 
-for col in TEXT_COLUMNS:
-    if col in df.columns:
-        df[col] = (
-            df[col]
-            .astype(str)
-            .str.strip()
-            #.str.title()
-        )
+def clean_text_columns(frame):
+    for col in TEXT_COLUMNS:
+        if col in frame.columns:
+            frame[col] = (
+                frame[col]
+                .astype(str)
+                .str.strip()
+                #.str.title()
+            )
+    return frame
+
+df = clean_text_columns(df)
+
+# =====================
+# DATE HANDLING & STATUS CLASSIFICATION
+# =====================
+exp_date_columns = [
+    "Registration_Expiry", "MVPI_Expiry", "Equipment_Insurance_Expiry", 
+    "Third_Party_Expiry", "License_Expiry", 
+    "Cert_Expiry", "Medical_Insurance_Expiry 1", "Fitness_Expiry 1",
+    "Certificate_Expiry", "Medical_Insurance_Expiry 2", "Fitness_Expiry 2"
+]
+
+NA_DATE_VALUES = ['N/A', 'NA', 'n/a', 'na']
+
+# Sheet date format, e.g. DATE_FORMAT=%d/%m/%Y. When unset it is guessed per
+# column from the first cell that reads the same month-first and day-first;
+# DATE_DAYFIRST=1 decides for columns where every cell is ambiguous.
+DATE_FORMAT = os.environ.get("DATE_FORMAT")
+DATE_DAYFIRST = os.environ.get("DATE_DAYFIRST", "").lower() in ("1", "true", "yes")
+
+CRITICAL_STATUSES = ["Expired", "For Renewal", "Expiring Today"]
+
+# Site timezone for deciding what "today" is, e.g. SITE_TIMEZONE=Asia/Manila.
+# Falls back to the server's local time when unset.
+SITE_TIMEZONE = os.environ.get("SITE_TIMEZONE")
+
+try:
+    SITE_TZ = ZoneInfo(SITE_TIMEZONE) if SITE_TIMEZONE else None
+except (ZoneInfoNotFoundError, ValueError) as e:
+    st.error(f"Invalid SITE_TIMEZONE '{SITE_TIMEZONE}': {e}")
+    st.stop()
+
+def site_now():
+    return datetime.now(SITE_TZ)
+
+def get_reference_date():
+    """Today's date at the site; date-dependent caches are keyed on it so they roll over at local midnight."""
+    return site_now().date()
+
+reference_date = get_reference_date()
+today = pd.Timestamp(reference_date)
+expiring_today = reference_date  # Use just the date part
+
+def classify_date(expiry_date):
+    if pd.isna(expiry_date):
+        return "No Date"
+    elif expiry_date.date() == expiring_today:  # Compare date parts only
+        return "Expiring Today"
+    elif expiry_date < today:
+        return "Expired"
+    elif expiry_date <= today + timedelta(days=15):
+        return "For Renewal"
+    else:
+        return "Valid"
+
+def classify_dates(dates, reference_date):
+    """Vectorized classify_date over a frame of expiry datetimes."""
+    reference = pd.Timestamp(reference_date)
+    statuses = pd.DataFrame("Valid", index=dates.index, columns=dates.columns)
+    statuses = statuses.mask(dates <= reference + timedelta(days=15), "For Renewal")
+    statuses = statuses.mask(dates < reference, "Expired")
+    statuses = statuses.mask(dates.apply(lambda col: col.dt.normalize()) == reference, "Expiring Today")
+    return statuses.mask(dates.isna(), "No Date")
+
+def guess_sheet_format(filled):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # pandas warns when a guess contradicts dayfirst
+        for value in filled.astype(str).head(100):
+            month_first = guess_datetime_format(value, dayfirst=False)
+            if month_first and month_first == guess_datetime_format(value, dayfirst=True):
+                return month_first
+        return guess_datetime_format(str(filled.iloc[0]), dayfirst=DATE_DAYFIRST)
+
+def parse_date_column(values):
+    """Parse one expiry column with the sheet format; returns (dates, ambiguous).
+
+    Cells the sheet format cannot read are parsed one by one. Those that read
+    differently month-first and day-first (e.g. 05/11/2026) are left as NaT
+    and marked ambiguous rather than guessed.
+    """
+    values = values.replace(NA_DATE_VALUES, pd.NaT)
+    filled = values.dropna()
+
+    sheet_format = DATE_FORMAT
+    if sheet_format is None and not filled.empty:
+        sheet_format = guess_sheet_format(filled)
+
+    if sheet_format:
+        dates = pd.to_datetime(values, format=sheet_format, errors="coerce")
+    else:
+        dates = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+
+    leftover = values[dates.isna() & values.notna()]
+    month_first = pd.to_datetime(leftover, format="mixed", dayfirst=False, errors="coerce")
+    day_first = pd.to_datetime(leftover, format="mixed", dayfirst=True, errors="coerce")
+    ambiguous = month_first.notna() & (month_first != day_first)
+    dates.loc[leftover.index] = month_first.where(~ambiguous)
+
+    return dates, ambiguous.reindex(values.index, fill_value=False)
+
+def parse_expiry_dates(frame):
+    """Return the expiry columns of `frame` as datetimes (N/A markers as NaT) and a mask of ambiguous cells."""
+    dates = pd.DataFrame(index=frame.index)
+    ambiguous = pd.DataFrame(index=frame.index)
+    for col in exp_date_columns:
+        if col in frame.columns:
+            dates[col], ambiguous[col] = parse_date_column(frame[col])
+    return dates, ambiguous
+
+# =====================
+# DATA VALIDATION & QUARANTINE
+# =====================
+# All row checks run as vectorized masks over the sheet once per data
+# version. Rows failing any check are kept out of every later stage and shown
+# in the Data Quality section with their reasons.
+OWNERSHIP_VALUES = ["Rental", "Subcontractor", "Company", "Unknown"]
+BLANK_TEXT_VALUES = ["", "NAN", "NONE", "<NA>"]
+# Markers the sheet uses for equipment without a plate; never duplicates
+PLATE_PLACEHOLDERS = ["N/A", "NA", "-", "--"]
+
+def get_data_version(frame):
+    """Content hash of the loaded sheet, used as the cache key for derived data."""
+    return str(pd.util.hash_pandas_object(frame, index=True).sum())
+
+def label_key(text):
+    """Upper-case alphanumerics only, so "Company Name" and "COMPANY_NAME" compare equal."""
+    return re.sub(r"[^A-Z0-9]", "", str(text).upper())
+
+def is_blank(values):
+    return values.isna() | values.astype(str).str.strip().str.upper().isin(BLANK_TEXT_VALUES)
+
+def has_registration(values):
+    return ~is_blank(values) & ~values.astype(str).str.strip().str.upper().isin(PLATE_PLACEHOLDERS)
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def validate_data(version, _frame):
+    """Split the sheet into clean and quarantined rows.
+
+    Returns (clean_df, clean_dates, quarantine_df), where clean_dates holds the
+    parsed expiry columns of clean_df and quarantine_df has an "Issues" column.
+    """
+    issues = pd.DataFrame(index=_frame.index)
+
+    header_cols = [col for col in dict.fromkeys(TEXT_COLUMNS + ["Company_Name"]) if col in _frame.columns]
+    header_row = pd.concat(
+        [
+            _frame[col].astype(str).str.upper().str.replace(r"[^A-Z0-9]", "", regex=True) == label_key(col)
+            for col in header_cols
+        ],
+        axis=1
+    ).any(axis=1)
+    issues["Header row"] = header_row
+
+    issues["Blank Equipment_Type"] = is_blank(_frame["Equipment_Type"]) & ~header_row
+
+    ownership = _frame["Ownership"].astype(str).str.strip().str.title()
+    ownership = ownership.mask(is_blank(_frame["Ownership"]), "Unknown")
+    issues["Unknown Ownership"] = ~ownership.isin(OWNERSHIP_VALUES) & ~header_row
+
+    dates, ambiguous = parse_expiry_dates(_frame)
+    na_markers = [value.upper() for value in NA_DATE_VALUES]
+    for col in dates.columns:
+        given = ~is_blank(_frame[col]) & ~_frame[col].astype(str).str.strip().str.upper().isin(na_markers)
+        issues[f"Unparseable {col}"] = given & dates[col].isna() & ~ambiguous[col] & ~header_row
+        issues[f"Ambiguous {col}"] = ambiguous[col] & ~header_row
+
+    # Only rows that passed every other check compete for a plate, so a
+    # quarantined first copy cannot push a valid later copy out as well
+    plates = _frame["Registration_Number"].astype(str).str.strip().str.upper()
+    has_plate = has_registration(_frame["Registration_Number"]) & ~issues.any(axis=1)
+    issues["Duplicate Registration_Number"] = has_plate & plates.where(has_plate).duplicated(keep="first")
+
+    flagged = issues.any(axis=1)
+
+    clean_df = _frame[~flagged].copy()
+    clean_df["Ownership"] = ownership[~flagged]
+
+    quarantine_df = _frame[flagged].copy()
+    quarantine_df.insert(0, "Issues", issues[flagged].dot(issues.columns + "; ").str.rstrip("; "))
+    quarantine_df.insert(0, "Sheet Row", quarantine_df.index + 2)  # 1-based, after the header row
+
+    return clean_df, dates[~flagged], quarantine_df
+
+data_version = get_data_version(df)
+df, document_dates, quarantine_df = validate_data(data_version, df)
+
+# =====================
+# CACHED OPTION LISTS & SEARCH INDEX
+# =====================
+# Option lists are keyed on a content hash of the sheet, so they are only
+# rebuilt when the data changes, not on every widget interaction.
+SEARCH_RESULT_LIMIT = 20
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_filter_options(version, _frame):
+    options = {}
+    for col in ["Equipment_Type", "Location", "Company_Name"]:
+        if col in _frame.columns:
+            options[col] = sorted(_frame[col].dropna().unique())
+        else:
+            options[col] = []
+    return options
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_registration_index(version, _frame, _dates):
+    """One row per plate: upper-cased search key and earliest document expiry, sorted by key."""
+    plates = _frame.loc[has_registration(_frame["Registration_Number"]), "Registration_Number"]
+    earliest = _dates.loc[plates.index].min(axis=1).groupby(plates).min()
+
+    index = pd.DataFrame({
+        "plate": earliest.index,
+        "earliest_expiry": earliest.values
+    })
+    index["key"] = index["plate"].astype(str).str.upper()
+    return index.sort_values("key", kind="stable").reset_index(drop=True)
+
+def search_registrations(index, query, limit=SEARCH_RESULT_LIMIT):
+    """Top `limit` plates matching `query`: prefix matches first, then substring matches."""
+    query = query.strip().upper()
+    if not query:
+        return index.iloc[0:0]
+
+    keys = index["key"]
+    start = keys.searchsorted(query)
+    matches = index.iloc[start:start + limit]
+    matches = matches[matches["key"].str.startswith(query)]
+
+    if len(matches) < limit:
+        contains = keys.str.contains(query, regex=False) & ~index.index.isin(matches.index)
+        matches = pd.concat([matches, index[contains].head(limit - len(matches))])
+
+    return matches
+
+filter_options = build_filter_options(data_version, df)
+registration_index = build_registration_index(data_version, df, document_dates)
 
 # -------------------------------------------------
 # OWNERSHIP FILTER
 # -------------------------------------------------
 ownership = st.sidebar.radio(
     "📋 Filter By Ownership:",
-    ["All", "Rental", "Subcontractor", "Company", "Unknown"],
+    ["All"] + OWNERSHIP_VALUES,
     help="Select equipment ownership type"
 )
 
 # -------------------------------------------------
-# Registration_Number FILTER
+# Registration_Number FILTER (SEARCH-AS-YOU-TYPE)
 # -------------------------------------------------
-registration_numbers = sorted(
-    df["Registration_Number"]
-    .dropna()
-    .unique()
+registration_query = st.sidebar.text_input(
+    "🔍 Search Registration_Number:",
+    placeholder="Type part of a plate number",
+    help=f"Shows the top {SEARCH_RESULT_LIMIT} matches with their current document status"
 )
 
+registration_matches = search_registrations(registration_index, registration_query)
+match_status = dict(zip(
+    registration_matches["plate"],
+    registration_matches["earliest_expiry"].map(classify_date)
+))
+
 selected_registration = st.sidebar.selectbox(
-    "🔍 Registration_Number:",
-    ["All"] + registration_numbers,
-    help="Filter by specific Registration_Number"
+    "🚘 Registration_Number:",
+    ["All"] + list(match_status),
+    format_func=lambda plate: plate if plate == "All" else f"{plate} · {match_status[plate]}",
+    help="Filter by specific Registration_Number (search above to list matches)"
 )
 
 # -------------------------------------------------
 # Equipment Type FILTER
 # -------------------------------------------------
-Equipment_Type = sorted(
-    df["Equipment_Type"]
-    .dropna()
-    .unique()
-)
+Equipment_Type = filter_options["Equipment_Type"]
 
 selected_equipment = st.sidebar.selectbox(
     "⚙️ Equipment_Type:",
@@ -131,14 +389,7 @@ selected_equipment = st.sidebar.selectbox(
 # -------------------------------------------------
 # LOCATION FILTER (MUST COME AFTER CLEANING)
 # -------------------------------------------------
-if "Location" in df.columns:
-    locations = sorted(
-        df["Location"]
-        .dropna()
-        .unique()
-    )
-else:
-    locations = []
+locations = filter_options["Location"]
 
 selected_location = st.sidebar.selectbox(
     "📍 Location:",
@@ -149,14 +400,7 @@ selected_location = st.sidebar.selectbox(
 # -------------------------------------------------
 # Company Name FILTER
 # -------------------------------------------------
-if "Company_Name" in df.columns:
-    company = sorted(
-        df["Company_Name"]
-        .dropna()
-        .unique()
-    )
-else:
-    company = []
+company = filter_options["Company_Name"]
 
 selected_company = st.sidebar.selectbox(
     "📰 Company_Name:",
@@ -263,156 +507,218 @@ else:
 #st.sidebar.markdown("• Detailed expiry management")
 
 # =====================
-# APPLY FILTERS
+# APPLY DATE STATUSES
 # =====================
-# Make a copy of the original data for debugging purposes
-original_df = df.copy()
-
-# Clean the data first - remove header rows and invalid entries
-df = df.dropna(subset=["Equipment_Type"])
-df = df[df["Equipment_Type"].astype(str).str.strip() != ""]
-df = df[df["Equipment_Type"].astype(str).str.upper() != "Equipment_Type"]
-
-# Try to find the serial number column
-#serial_col = None
-#possible_serial_cols = ["S.NO.", "S.No.", "S.No", "Serial No.", "Serial No", "SNo", "Index", "No.", "S. No."]
-
-#for col in possible_serial_cols:
-#    if col in df.columns:
-#        serial_col = col
-#        break
-
-#if serial_col:
-#    df = df[df[serial_col].notna() & (df[serial_col].astype(str).str.strip() != "") & (df[serial_col].astype(str).str.upper() != serial_col.upper())]
-#    st.sidebar.info(f"📊 Using '{serial_col}' column for equipment counting")
-#else:
-#    st.sidebar.warning("⚠️ Serial number column not found. Using all rows with Equipment_Type.")
+# Two cache layers: parsed dates (from validate_data) depend only on the data
+# version and survive the day change; statuses and critical-document lists are also keyed on the
+# reference date, so they are recomputed once after local midnight.
+DETAIL_COLUMNS = [
+    "Equipment_Type",
+    "Registration_Number",
+    "Ownership",
+    "Company_Name",
+    "Document Type",
+    "Expiry Date"
+]
 
-# Clean ownership data and remove header-like entries
-df.loc[:, "Ownership"] = df["Ownership"].astype(str).str.strip().str.title()
-df = df[df["Ownership"].fillna("").str.upper() != "ownership"]
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_critical_documents(version, reference_date, _frame, _dates):
+    """One row per Expired / For Renewal / Expiring Today document across the whole sheet.
 
-filtered_df = df.copy()
+    Rows keep the source row label in "Row" so filters can be applied afterwards.
+    """
+    statuses = classify_dates(_dates, reference_date).stack(future_stack=True)
+    expiry = _dates.stack(future_stack=True)
+    critical = statuses.isin(CRITICAL_STATUSES)
+    statuses, expiry = statuses[critical], expiry[critical]
 
-if ownership != "All":
-    filtered_df = filtered_df[filtered_df["Ownership"] == ownership]
+    rows = statuses.index.get_level_values(0)
+    documents = _frame.loc[rows, DETAIL_COLUMNS[:4]].reset_index(drop=True)
+    documents.insert(0, "Row", rows)
+    documents["Document Type"] = statuses.index.get_level_values(1)
+    documents["Expiry Date"] = expiry.values
+    documents["Status"] = statuses.values
+    return documents
 
-if selected_registration != "All":
-    filtered_df = filtered_df[filtered_df["Registration_Number"] == selected_registration]
+critical_documents = build_critical_documents(data_version, reference_date, df, document_dates)
 
-if selected_equipment != "All":
-    filtered_df = filtered_df[filtered_df["Equipment_Type"] == selected_equipment]
 
-if selected_location != "All":
-    filtered_df = filtered_df[filtered_df["Location"] == selected_location]
+#st.sidebar.write(f"Debug - Target date: {expiring_today}")
+#st.sidebar.write(f"Debug - Target date type: {type(expiring_today)}")
 
-if selected_company != "All":
-    filtered_df = filtered_df[filtered_df["Company_Name"] == selected_company]
 
 # =====================
-# DATE HANDLING & STATUS CLASSIFICATION  
+# MAIN DASHBOARD
 # =====================
-exp_date_columns = [
-    "Registration_Expiry", "MVPI_Expiry", "Equipment_Insurance_Expiry", 
-    "Third_Party_Expiry", "License_Expiry", 
-    "Cert_Expiry", "Medical_Insurance_Expiry 1", "Fitness_Expiry 1",
-    "Certificate_Expiry", "Medical_Insurance_Expiry 2", "Fitness_Expiry 2"
-]
-
-# First, clean N/A and NA values before datetime conversion
-for col in exp_date_columns:
-    if col in filtered_df.columns:
-        filtered_df[col] = filtered_df[col].replace(['N/A', 'NA', 'n/a', 'na'], pd.NaT)
-        filtered_df[col] = pd.to_datetime(filtered_df[col], errors="coerce")
-
-today = pd.to_datetime(datetime.today().date())
-expiring_today = pd.to_datetime('today').date()  # Use just the date part
-
-def classify_date(expiry_date):
-    if pd.isna(expiry_date):
-        return "No Date"
-    elif expiry_date.date() == expiring_today:  # Compare date parts only
-        return "Expiring Today"
-    elif expiry_date < today:
-        return "Expired"
-    elif expiry_date <= today + timedelta(days=15):
-        return "For Renewal"
-    else:
-        return "Valid"
+st.markdown('<div class="main-header">📆 Heavy Equipment/Vehicles Document Expiry Status - PH III</div>', unsafe_allow_html=True)
 
-# Add status columns
-for col in exp_date_columns:
-    if col in filtered_df.columns:
-        filtered_df[f"{col}_Status"] = filtered_df[col].apply(classify_date)
+# =====================
+# DATA QUALITY
+# =====================
+if not quarantine_df.empty:
+    with st.expander(f"🧹 {len(quarantine_df)} Rows Quarantined by Data Validation"):
+        st.caption("These rows are excluded from all counts, charts and exports. Fix them in the sheet and refresh.")
+        st.dataframe(quarantine_df, use_container_width=True, hide_index=True)
 
-status_columns = [f"{col}_Status" for col in exp_date_columns if col in filtered_df.columns]
+# =====================
+# EXPIRY DIGEST (BACKGROUND WORKER)
+# =====================
+# A daemon thread, started once per server process, reruns the same load ->
+# clean -> validate pipeline every refresh cycle and stores a small digest of
+# upcoming expiries. The page only reads the stored digest; the worker also
+# keeps load_data's cache warm. Set DIGEST_OUTBOX_DIR to also write each
+# digest as JSON for downstream mailers.
+DIGEST_WINDOWS = [1, 7, 15, 30]
+DIGEST_REFRESH_SECONDS = DATA_TTL_SECONDS
+DIGEST_OUTBOX_DIR = os.environ.get("DIGEST_OUTBOX_DIR")
+
+def count_by(values):
+    return {str(key): int(count) for key, count in pd.Series(values).value_counts().items()}
+
+def build_digest(version, frame, dates, reference_date):
+    """Documents expiring within each of DIGEST_WINDOWS days of `reference_date`, grouped by company and location."""
+    reference = pd.Timestamp(reference_date)
+    expiry = pd.to_datetime(dates.stack(future_stack=True)).dropna()
+    days_left = (expiry.dt.normalize() - reference).dt.days.to_numpy()
+
+    rows = expiry.index.get_level_values(0)
+    groups = {}
+    for col in ["Company_Name", "Location"]:
+        if col in frame.columns:
+            # Text columns hold the literal "nan" after clean_text_columns
+            values = frame.loc[rows, col]
+            groups[col] = values.mask(is_blank(values), "Unknown").to_numpy()
+        else:
+            groups[col] = pd.Series("Unknown", index=rows).to_numpy()
+
+    windows = {}
+    for days in DIGEST_WINDOWS:
+        in_window = (days_left >= 0) & (days_left <= days)
+        windows[str(days)] = {
+            "total": int(in_window.sum()),
+            "by_company": count_by(groups["Company_Name"][in_window]),
+            "by_location": count_by(groups["Location"][in_window])
+        }
 
+    return {
+        "generated_at": site_now().isoformat(timespec="seconds"),
+        "reference_date": reference_date.isoformat(),
+        "data_version": version,
+        "windows": windows
+    }
 
-#st.sidebar.write(f"Debug - Target date: {expiring_today}")
-#st.sidebar.write(f"Debug - Target date type: {type(expiring_today)}")
+def compute_digest():
+    frame = clean_text_columns(load_data())
+    version = get_data_version(frame)
+    frame, dates, _ = validate_data(version, frame)
+    return build_digest(version, frame, dates, get_reference_date())
+
+def write_digest_outbox(digest):
+    os.makedirs(DIGEST_OUTBOX_DIR, exist_ok=True)
+    path = os.path.join(DIGEST_OUTBOX_DIR, f"expiry-digest-{digest['reference_date']}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(digest, f, indent=2)
+    os.replace(path + ".tmp", path)  # mailers never see a half-written file
+
+def run_digest_worker(store):
+    while True:
+        try:
+            digest = compute_digest()
+            store["digest"] = digest
+            store["error"] = None
+            if DIGEST_OUTBOX_DIR:
+                write_digest_outbox(digest)
+        except Exception as e:
+            store["error"] = str(e)
+        time.sleep(DIGEST_REFRESH_SECONDS)
+
+@st.cache_resource
+def start_digest_worker():
+    store = {"digest": None, "error": None}
+    threading.Thread(
+        target=run_digest_worker,
+        args=(store,),
+        name="expiry-digest",
+        daemon=True
+    ).start()
+    return store
+
+digest_store = start_digest_worker()
+digest = digest_store["digest"]
+if (
+    digest is None
+    or digest["reference_date"] != reference_date.isoformat()
+    or digest["data_version"] != data_version
+):
+    # First run, past midnight, or data refreshed before the worker's next cycle
+    digest = build_digest(data_version, df, document_dates, reference_date)
+
+st.markdown("### 📬 Upcoming Expiries")
+digest_cols = st.columns(len(DIGEST_WINDOWS))
+for digest_col, days in zip(digest_cols, DIGEST_WINDOWS):
+    with digest_col:
+        st.metric(
+            label=f"📅 Next {days} Day{'s' if days > 1 else ''}",
+            value=digest["windows"][str(days)]["total"],
+            help=f"Documents expiring between today and {days} day(s) from now, all equipment"
+        )
 
+with st.expander("📋 Upcoming Expiries by Company and Location"):
+    digest_days = st.radio(
+        "Window:",
+        DIGEST_WINDOWS,
+        index=1,
+        format_func=lambda days: f"Next {days} Day{'s' if days > 1 else ''}",
+        horizontal=True
+    )
+    window = digest["windows"][str(digest_days)]
+    col1, col2 = st.columns(2)
+    with col1:
+        st.dataframe(
+            pd.DataFrame(window["by_company"].items(), columns=["Company", "Documents"]),
+            use_container_width=True,
+            hide_index=True
+        )
+    with col2:
+        st.dataframe(
+            pd.DataFrame(window["by_location"].items(), columns=["Location", "Documents"]),
+            use_container_width=True,
+            hide_index=True
+        )
+    st.caption(f"Digest generated {digest['generated_at']} for {digest['reference_date']}")
+    if digest_store["error"]:
+        st.caption(f"⚠️ Last background refresh failed: {digest_store['error']}")
 
-# =====================
-# MAIN DASHBOARD
-# =====================
-st.markdown('<div class="main-header">📆 Heavy Equipment/Vehicles Document Expiry Status - PH III</div>', unsafe_allow_html=True)
+st.markdown("---")
 
 # =====================
 # BUILD DETAILED LISTS AND COUNT DOCUMENTS CONSISTENTLY
 # =====================
-expired_details = []
-renewal_details = []
-expiring_today_details = []
+# Restrict the cached critical documents to the filtered rows
+filtered_documents = critical_documents[critical_documents["Row"].isin(filtered_df.index)]
+
+def documents_with_status(status):
+    selected = filtered_documents[filtered_documents["Status"] == status]
+    return selected[DETAIL_COLUMNS].reset_index(drop=True)
+
+expired_df = documents_with_status("Expired")
+renewal_df = documents_with_status("For Renewal")
+expiring_today_df = documents_with_status("Expiring Today")
 
 # Counters for total documents in each category
-expired_count = 0
-renewal_count = 0
-expiring_today_count = 0
+expired_count = len(expired_df)
+renewal_count = len(renewal_df)
+expiring_today_count = len(expiring_today_df)
 
 # Debug section - FIXED to use date comparison
 st.sidebar.write("Debug - Document counts by column:")
-expiring_today_by_column = {}
+expiring_today_by_column = expiring_today_df["Document Type"].value_counts()
 
 for col in exp_date_columns:
     if col in filtered_df.columns:
-        # FIX: Compare date parts only, handle NaT values properly
-        expiring_today_count_col = 0
-        for _, row in filtered_df.iterrows():
-            if pd.notna(row[col]) and row[col].date() == expiring_today:
-                expiring_today_count_col += 1
-        
-        expiring_today_by_column[col] = expiring_today_count_col
+        expiring_today_count_col = expiring_today_by_column.get(col, 0)
         st.sidebar.write(f"• {col}: {expiring_today_count_col} expiring today")
 
-# Process all columns and count documents by status
-for _, row in filtered_df.iterrows():
-    for doc, status_col in zip(exp_date_columns, status_columns):
-        if doc in filtered_df.columns and status_col in filtered_df.columns:
-            detail = {
-                "Equipment_Type": row["Equipment_Type"],
-                "Registration_Number": row["Registration_Number"],
-                "Ownership": row["Ownership"],
-                "Company_Name": row["Company_Name"],
-                "Document Type": doc,
-                "Expiry Date": row[doc]
-            }
-            
-            # Count each document by its status
-            if row[status_col] == "Expired":
-                expired_details.append(detail)
-                expired_count += 1
-            elif row[status_col] == "For Renewal":
-                renewal_details.append(detail)
-                renewal_count += 1
-            elif row[status_col] == "Expiring Today":
-                expiring_today_details.append(detail)
-                expiring_today_count += 1
-
-# Convert to DataFrames
-expired_df = pd.DataFrame(expired_details)
-renewal_df = pd.DataFrame(renewal_details)
-expiring_today_df = pd.DataFrame(expiring_today_details)
-
 st.sidebar.write("---")
 st.sidebar.write("📊 **Document Count Summary:**")
 st.sidebar.write(f"• Expired Documents: {expired_count}")
@@ -639,6 +945,133 @@ with col1[0]:
     else:
         st.success("🎉 No documents expiring today!")
 
+# =====================
+# EXPORT CRITICAL DOCUMENTS
+# =====================
+# Exports are written chunk by chunk straight from the document frames, so
+# only one chunk is ever formatted/converted at a time.
+EXPORT_CHUNK_ROWS = 5000
+
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+def iter_chunks(frame, chunk_rows=EXPORT_CHUNK_ROWS):
+    for start in range(0, len(frame), chunk_rows):
+        yield frame.iloc[start:start + chunk_rows]
+
+def write_documents(frame, file_format, buffer):
+    """Write `frame` to the binary `buffer` in `file_format`, one chunk at a time."""
+    if file_format == "CSV":
+        frame.head(0).to_csv(buffer, index=False)
+        for chunk in iter_chunks(frame):
+            chunk.to_csv(buffer, header=False, index=False, date_format="%b-%d-%Y")
+
+    elif file_format == "Parquet":
+        text_cols = [col for col in frame.columns if frame[col].dtype == object]
+        schema = pa.schema([
+            (col, pa.string() if col in text_cols else pa.from_numpy_dtype(frame[col].dtype))
+            for col in frame.columns
+        ])
+        with pq.ParquetWriter(buffer, schema) as writer:
+            for chunk in iter_chunks(frame):
+                chunk = chunk.astype({col: "string" for col in text_cols})
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+    elif file_format == "Excel":
+        # constant_memory flushes each row once a later row is started, so cells
+        # must be written strictly row by row (to_excel writes column by column)
+        workbook = xlsxwriter.Workbook(buffer, {
+            "constant_memory": True,
+            "default_date_format": "mmm-dd-yyyy"
+        })
+        worksheet = workbook.add_worksheet("Documents")
+        worksheet.write_row(0, 0, list(frame.columns))
+        next_row = 1
+        for chunk in iter_chunks(frame):
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            for values in chunk.itertuples(index=False):
+                worksheet.write_row(next_row, 0, values)
+                next_row += 1
+        workbook.close()
+
+def build_export(frame, file_format, split_by_company, stem):
+    """Return (file_name, mime, payload) for `frame`, optionally as a ZIP with one file per company."""
+    extension, mime = EXPORT_FORMATS[file_format]
+
+    if not split_by_company:
+        buffer = io.BytesIO()
+        write_documents(frame, file_format, buffer)
+        return f"{stem}.{extension}", mime, buffer.getvalue()
+
+    # Company_Name is not in TEXT_COLUMNS, so strip it here to avoid
+    # "ACME Corp" and "ACME Corp " becoming separate files
+    companies = frame["Company_Name"].where(
+        frame["Company_Name"].isna(),
+        frame["Company_Name"].astype(str).str.strip()
+    )
+
+    buffer = io.BytesIO()
+    used_names = set()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for company_name, company_frame in frame.groupby(companies, dropna=False, sort=True):
+            company_name = "" if pd.isna(company_name) else str(company_name)
+            safe_name = re.sub(r"[^A-Za-z0-9]+", "_", company_name).strip("_") or "Unknown"
+
+            # Distinct companies can sanitize to the same name ("A&B", "A/B")
+            entry_name, suffix = safe_name, 1
+            while entry_name in used_names:
+                suffix += 1
+                entry_name = f"{safe_name}_{suffix}"
+            used_names.add(entry_name)
+
+            with archive.open(f"{stem}_{entry_name}.{extension}", "w") as entry:
+                # ZIP entries are not seekable; Parquet/Excel writers need a seekable buffer
+                entry_buffer = io.BytesIO() if file_format != "CSV" else entry
+                write_documents(company_frame, file_format, entry_buffer)
+                if entry_buffer is not entry:
+                    entry.write(entry_buffer.getvalue())
+    return f"{stem}_by_company.zip", "application/zip", buffer.getvalue()
+
+st.markdown("---")
+st.markdown("### 📤 Export Critical Documents")
+
+export_sets = {
+    "Expired": expired_df,
+    "For Renewal": renewal_df,
+    "Expiring Today": expiring_today_df
+}
+
+col1, col2, col3 = st.columns(3)
+with col1:
+    export_set = st.selectbox("📄 Document Set:", list(export_sets))
+with col2:
+    export_format = st.radio("💾 Format:", list(EXPORT_FORMATS), horizontal=True)
+with col3:
+    split_by_company = st.checkbox(
+        "🏢 Split by company (ZIP)",
+        help="One file per Company_Name, bundled into a single ZIP"
+    )
+
+export_df = export_sets[export_set]
+if export_df.empty:
+    st.info(f"No {export_set.lower()} documents to export for the current filters.")
+elif st.button(f"📦 Prepare {len(export_df)} {export_set} Documents"):
+    stem = "{}_documents_{}".format(
+        export_set.lower().replace(" ", "_"),
+        today.strftime("%Y-%m-%d")
+    )
+    file_name, mime, payload = build_export(export_df, export_format, split_by_company, stem)
+    st.download_button(
+        f"⬇️ Download {file_name}",
+        data=payload,
+        file_name=file_name,
+        mime=mime,
+        on_click="ignore"
+    )
+
 # =====================
 # ADDITIONAL INSIGHTS
 # =====================